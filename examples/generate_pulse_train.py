@@ -0,0 +1,20 @@
+from spectroscopypy import PulseDataFileReader, RedPitaya
+import numpy as np
+import sys
+
+
+def read_pulse(path, samples_per_pulse):
+    with PulseDataFileReader(path, samples_per_pulse) as reader:
+        return reader.read()
+    
+def main(host, channel_id, path, samples_per_pulse, rate, count):
+    pulse = read_pulse(path, samples_per_pulse).smooth()
+    amplitudes = np.linspace(0.05, 1.0, 20)
+    spectrum = np.exp(-amplitudes / 0.3)
+    red_pitaya = RedPitaya(host)
+    with red_pitaya.get_generator_channel(channel_id) as channel:
+        channel.load_bank(pulse, amplitudes)
+        channel.play_train(spectrum, rate, count)
+
+if __name__ == '__main__':
+    main(sys.argv[1], int(sys.argv[2]), sys.argv[3], int(sys.argv[4]), float(sys.argv[5]), int(sys.argv[6]))
@@ -1,12 +1,21 @@
 from abc import ABCMeta, abstractmethod, abstractproperty
 from array import array
 from collections import namedtuple
+import errno
+import hashlib
+import inspect
+import os
+import tempfile
+from time import sleep, time as now
 import matplotlib.pyplot as plt
 import numpy as np
 from scpipy import Waveform, TriggerSource, Edge, get_tcpip_scpi_connection, Oscilloscope, Generator
 
 
 Sample = namedtuple('Sample', ['time', 'voltage'])
+Event = namedtuple('Event', ['time', 'amplitude'])
+
+BI_207_CONVERSION_ELECTRON_ENERGIES = (481.69, 975.65)
 
 
 class Pulse(object):
@@ -19,7 +28,7 @@ class Pulse(object):
 
     def __getitem__(self, position):
         if isinstance(position, slice):
-            return Pulse(self._samples[position])
+            return self._view(('slice', position))
         else:
             return self._samples[position]
 
@@ -47,36 +56,365 @@ class Pulse(object):
         return tuple([voltage for _, voltage in self._samples])
 
     def smooth(self, window_size=1000, order=4):
-        '''http://scipy.github.io/old-wiki/pages/Cookbook/SavitzkyGolay'''
-        order_range = range(order + 1)
-        half_window = (window_size - 1) // 2
-        b = np.mat([[k**i for i in order_range] for k in range(-half_window, half_window + 1)])
-        m = np.linalg.pinv(b).A[0]
-
-        y = np.asarray(self.voltages)
-        firstvals = y[0] - np.abs(y[1:half_window+1][::-1] - y[0])
-        lastvals = y[-1] + np.abs(y[-half_window-1:-1][::-1] - y[-1])
-        
-        smoothed_y = np.convolve(m[::-1],
-                                 np.concatenate((firstvals, y, lastvals)),
-                                 mode='valid')
-
-        return Pulse(tuple([Sample(time, voltage) for time, voltage in zip(self.times, smoothed_y)]))
+        if window_size > len(self):
+            raise ValueError('Smoothing window is longer than the pulse')
+        return self._view(('smooth', window_size, order))
         
     def normalize_times(self):
-        min_time = min(self.times)
-        return Pulse(tuple(
-            Sample(time, voltage)
-            for time, voltage
-            in zip([time - min_time for time in self.times], self.voltages)))
+        return self._view(('normalize_times',))
 
     def normalize_voltages(self):
-        max_voltage = max(self.voltages)
-        return Pulse(tuple(
-            Sample(time, voltage)
-            for time, voltage
-            in zip(self.times, [1.0*voltage/max_voltage for voltage in self.voltages])))
-        
+        return self._view(('normalize_voltages',))
+
+    def _view(self, operation):
+        return PulseView(self, (operation,))
+
+    def _get_arrays(self):
+        return np.array(self.times, dtype=float), np.array(self.voltages, dtype=float)
+
+
+class PulseView(Pulse):
+    '''Pulse evaluated lazily from a source pulse and a chain of transforms.'''
+
+    def __init__(self, source, operations):
+        self._source = source
+        self._operations = operations
+        self._arrays = None
+
+    def __len__(self):
+        length = len(self._source)
+        for operation in self._operations:
+            if operation[0] == 'slice':
+                length = len(range(*operation[1].indices(length)))
+        return length
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return self._view(('slice', position))
+        times, voltages = self._get_arrays()
+        return Sample(times[position].item(), voltages[position].item())
+
+    def __contains__(self, item):
+        return any(sample == item for sample in self)
+
+    def __iter__(self):
+        times, voltages = self._get_arrays()
+        for sample_time, voltage in zip(times, voltages):
+            yield Sample(sample_time.item(), voltage.item())
+
+    @property
+    def _samples(self):
+        return tuple(self)
+
+    def get_maximum_voltage(self):
+        return self._get_arrays()[1].max().item()
+
+    @property
+    def times(self):
+        return tuple(self._get_arrays()[0].tolist())
+
+    @property
+    def voltages(self):
+        return tuple(self._get_arrays()[1].tolist())
+
+    @property
+    def operations(self):
+        return self._operations
+
+    def _view(self, operation):
+        return PulseView(self._source, self._operations + (operation,))
+
+    def _get_arrays(self):
+        if self._arrays is None:
+            self._arrays = self._evaluate()
+        return self._arrays
+
+    def _evaluate(self):
+        times, voltages = self._source._get_arrays()
+        time_offset = 0.0
+        voltage_divisor = 1.0
+        for operation in self._operations:
+            if operation[0] == 'slice':
+                times = times[operation[1]]
+                voltages = voltages[operation[1]]
+            elif operation[0] == 'normalize_times':
+                time_offset = -times.min()
+            elif operation[0] == 'normalize_voltages':
+                voltage_divisor = voltages.max() if voltage_divisor > 0 else voltages.min()
+            elif operation[0] == 'smooth':
+                if voltage_divisor != 1.0:
+                    voltages = voltages / voltage_divisor
+                    voltage_divisor = 1.0
+                voltages = savitzky_golay(voltages, operation[1], operation[2])
+        if time_offset != 0.0:
+            times = times + time_offset
+        if voltage_divisor != 1.0:
+            voltages = 1.0 * voltages / voltage_divisor
+        return times, voltages
+
+
+class CompactPulse(Pulse):
+    '''Pulse on a uniform time axis t0 + i * dt with voltages code * scale + offset.'''
+
+    CODE_RANGE = 2**16 - 2
+    CHUNK_SIZE = 4096
+
+    def __init__(self, t0, dt, codes, scale=1.0, offset=0.0):
+        self._t0 = t0
+        self._dt = dt
+        self._codes = np.asarray(codes, dtype=np.int16)
+        self._scale = scale
+        self._offset = offset
+
+    @classmethod
+    def from_arrays(cls, times, voltages):
+        times = np.asarray(times, dtype=float)
+        voltages = np.asarray(voltages, dtype=float)
+        if len(times) == 0:
+            return cls(0.0, 0.0, np.zeros(0, dtype=np.int16))
+        dt = (times[-1] - times[0]) / (len(times) - 1) if len(times) > 1 else 0.0
+        if not np.allclose(np.diff(times), dt, rtol=1e-6, atol=0):
+            raise ValueError('Time axis is not uniform')
+        minimum, maximum = voltages.min(), voltages.max()
+        offset = (maximum + minimum) / 2
+        scale = (maximum - minimum) / cls.CODE_RANGE if maximum > minimum else 1.0
+        codes = np.round((voltages - offset) / scale).astype(np.int16)
+        return cls(float(times[0]), float(dt), codes, float(scale), float(offset))
+
+    def __len__(self):
+        return len(self._codes)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            start, _, step = position.indices(len(self._codes))
+            return CompactPulse(self._t0 + start * self._dt, self._dt * step,
+                                self._codes[position].copy(), self._scale, self._offset)
+        if position < 0:
+            position += len(self._codes)
+        if not 0 <= position < len(self._codes):
+            raise IndexError('Pulse index out of range')
+        return Sample(self._t0 + position * self._dt,
+                      float(self._codes[position]) * self._scale + self._offset)
+
+    def __contains__(self, item):
+        return any(sample == item for sample in self)
+
+    def __iter__(self):
+        for start in range(0, len(self._codes), self.CHUNK_SIZE):
+            times, voltages = self._get_arrays(start, start + self.CHUNK_SIZE)
+            for sample_time, voltage in zip(times.tolist(), voltages.tolist()):
+                yield Sample(sample_time, voltage)
+
+    @property
+    def _samples(self):
+        return tuple(self)
+
+    def get_maximum_voltage(self):
+        return self._codes.max() * self._scale + self._offset
+
+    @property
+    def times(self):
+        return tuple(self._get_arrays()[0].tolist())
+
+    @property
+    def voltages(self):
+        return tuple(self._get_arrays()[1].tolist())
+
+    @property
+    def t0(self):
+        return self._t0
+
+    @property
+    def dt(self):
+        return self._dt
+
+    @property
+    def codes(self):
+        return self._codes
+
+    @property
+    def scale(self):
+        return self._scale
+
+    @property
+    def offset(self):
+        return self._offset
+
+    def _get_arrays(self, start=0, stop=None):
+        codes = self._codes[start:stop]
+        return (self._t0 + self._dt * np.arange(start, start + len(codes)),
+                codes * self._scale + self._offset)
+
+
+def subtract_baseline(voltages, pre_trigger_samples):
+    '''Subtract from each pulse (last axis) the mean of its pre-trigger voltages.'''
+    voltages = np.asarray(voltages, dtype=float)
+    if pre_trigger_samples == 0:
+        return voltages
+    return voltages - voltages[..., :pre_trigger_samples].mean(axis=-1)[..., np.newaxis]
+
+
+def make_pulse(times, voltages, compact=False, pre_trigger_samples=0):
+    if pre_trigger_samples:
+        voltages = subtract_baseline(voltages, pre_trigger_samples)
+    if compact:
+        return CompactPulse.from_arrays(times, voltages)
+    return Pulse(tuple([Sample(sample_time, voltage) for sample_time, voltage in zip(times, voltages)]))
+
+
+def savitzky_golay(y, window_size=1000, order=4):
+    '''http://scipy.github.io/old-wiki/pages/Cookbook/SavitzkyGolay'''
+    order_range = range(order + 1)
+    half_window = (window_size - 1) // 2
+    b = np.array([[k**i for i in order_range] for k in range(-half_window, half_window + 1)])
+    m = np.linalg.pinv(b)[0]
+
+    y = np.asarray(y)
+    firstvals = y[0] - np.abs(y[1:half_window+1][::-1] - y[0])
+    lastvals = y[-1] + np.abs(y[-half_window-1:-1][::-1] - y[-1])
+
+    return np.convolve(m[::-1],
+                       np.concatenate((firstvals, y, lastvals)),
+                       mode='valid')
+
+
+class PulseCache(object):
+    '''Content-addressed on-disk store of pulse transform results.'''
+
+    VERSION = 1
+    SUFFIX = '.dat'
+    VALUE_SUFFIX = '.npy'
+    TEMPORARY_SUFFIX = '.tmp'
+    STALE_TEMPORARY_AGE = 3600
+
+    def __init__(self, directory, max_size=1024**3):
+        self._directory = directory
+        self._max_size = max_size
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+
+    @property
+    def directory(self):
+        return self._directory
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    def apply(self, pulse, transform, **parameters):
+        key = self.get_key(pulse, transform, **parameters)
+        result = self.get(key)
+        if result is None:
+            result = getattr(pulse, transform)(**parameters)
+            if isinstance(result, Pulse):
+                result = Pulse(tuple(result))
+            else:
+                result = self._to_value(np.asarray(result, dtype=float))
+            self.put(key, result)
+        return result
+
+    def get_key(self, pulse, transform, **parameters):
+        digest = hashlib.sha1()
+        digest.update(np.asarray(pulse.times, dtype=float).tobytes())
+        digest.update(np.asarray(pulse.voltages, dtype=float).tobytes())
+        arguments = inspect.getcallargs(getattr(pulse, transform), **parameters)
+        del arguments['self']
+        digest.update(repr((self.VERSION, transform, sorted(arguments.items()))).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        data = self._read(self._get_path(key), np.fromfile)
+        if data is not None:
+            samples_per_pulse = len(data) // 2
+            return Pulse(tuple([Sample(sample_time, voltage) for sample_time, voltage
+                                in zip(data[:samples_per_pulse].tolist(), data[samples_per_pulse:].tolist())]))
+        value = self._read(self._get_path(key, self.VALUE_SUFFIX), np.load)
+        if value is not None:
+            return self._to_value(value)
+        return None
+
+    def put(self, key, result):
+        descriptor, temporary_path = tempfile.mkstemp(dir=self._directory, suffix=self.TEMPORARY_SUFFIX)
+        try:
+            with os.fdopen(descriptor, 'wb') as data_file:
+                if isinstance(result, Pulse):
+                    path = self._get_path(key)
+                    array('d', result.times).tofile(data_file)
+                    array('d', result.voltages).tofile(data_file)
+                else:
+                    path = self._get_path(key, self.VALUE_SUFFIX)
+                    np.save(data_file, np.asarray(result, dtype=float))
+            self._rename(temporary_path, path)
+        except:
+            self._remove(temporary_path)
+            raise
+        self._evict()
+
+    def clear(self):
+        for path, _, _ in self._get_entries():
+            self._remove(path)
+
+    def _get_path(self, key, suffix=SUFFIX):
+        return os.path.join(self._directory, key + suffix)
+
+    def _read(self, path, load):
+        try:
+            with open(path, 'rb') as data_file:
+                data = load(data_file)
+            os.utime(path, None)
+        except (IOError, OSError) as error:
+            if error.errno != errno.ENOENT:
+                raise
+            return None
+        return data
+
+    def _to_value(self, value):
+        return value[()] if value.ndim == 0 else value
+
+    def _rename(self, temporary_path, path):
+        try:
+            getattr(os, 'replace', os.rename)(temporary_path, path)
+        except OSError:
+            if not os.path.exists(path):
+                raise
+            self._remove(temporary_path)
+
+    def _get_entries(self):
+        entries = []
+        stale_time = now() - self.STALE_TEMPORARY_AGE
+        for name in os.listdir(self._directory):
+            if not name.endswith((self.SUFFIX, self.VALUE_SUFFIX, self.TEMPORARY_SUFFIX)):
+                continue
+            path = os.path.join(self._directory, name)
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith(self.TEMPORARY_SUFFIX) and status.st_mtime > stale_time:
+                continue
+            entries.append((path, status.st_mtime, status.st_size))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._get_entries(), key=lambda entry: entry[1])
+        total_size = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if total_size <= self._max_size:
+                break
+            self._remove(path)
+            total_size -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+
 
 def plot_pulse(reader, writer):
     reader.open()
@@ -127,10 +465,12 @@ class PulseWriter(PulseIO):
 
 class PulseDataFileReader(PulseReader):
 
-    def __init__(self, path, samples_per_pulse):
+    def __init__(self, path, samples_per_pulse, compact=False, pre_trigger_samples=0):
         self._path = path
         self._file = None
         self._samples_per_pulse = samples_per_pulse
+        self._compact = compact
+        self._pre_trigger_samples = pre_trigger_samples
 
     def open(self):
         self._file = open(self._path, 'r')
@@ -142,7 +482,7 @@ class PulseDataFileReader(PulseReader):
         voltages = array('d')
         voltages.read(self._file, self._samples_per_pulse)
         
-        return Pulse(tuple([Sample(time, voltage) for time, voltage in zip(times, voltages)]))
+        return make_pulse(times, voltages, self._compact, self._pre_trigger_samples)
 
     def close(self):
         self._file.close()
@@ -183,12 +523,143 @@ class PulsePlotter(PulseWriter):
         return self._closed
 
 
+class PeakTrackingCalibrator(PulseWriter):
+    '''Energy calibration refitted on known peaks as pulses are written.'''
+
+    def __init__(self, peak_amplitudes, peak_energies=BI_207_CONVERSION_ELECTRON_ENERGIES,
+                 amplitude_range=(0.0, 1.0), energy_range=None, bins=1024, window=16,
+                 update_interval=1000, memory=0.5):
+        if len(peak_amplitudes) != len(peak_energies):
+            raise ValueError('Peak amplitudes and energies sizes differ')
+        if 2 * window + 1 > bins:
+            raise ValueError('Peak window is wider than the histogram')
+        if energy_range is None:
+            energy_range = (0.0, 1.25 * max(peak_energies))
+        self._peak_positions = np.array(peak_amplitudes, dtype=float)
+        self._peak_energies = np.array(peak_energies, dtype=float)
+        self._amplitude_edges = np.linspace(amplitude_range[0], amplitude_range[1], bins + 1)
+        self._amplitude_counts = np.zeros(bins)
+        self._energy_edges = np.linspace(energy_range[0], energy_range[1], bins + 1)
+        self._energy_counts = np.zeros(bins)
+        if len(peak_amplitudes) == 1 and not self._is_away_from_zero(peak_amplitudes[0]):
+            raise ValueError('Single peak amplitude must not be zero')
+        self._window = window
+        self._update_interval = update_interval
+        self._memory = memory
+        self._pulse_count = 0
+        self._pulses_since_update = 0
+        self._history = [(0, tuple(self._peak_positions))]
+        self._closed = True
+        self._update_calibration()
+
+    def open(self):
+        self._closed = False
+
+    def close(self):
+        self._closed = True
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def write(self, pulse):
+        amplitude = pulse.get_maximum_voltage()
+        energy = self.calibrate(amplitude)
+        self._add(self._amplitude_edges, self._amplitude_counts, amplitude)
+        self._add(self._energy_edges, self._energy_counts, energy)
+
+        self._pulse_count += 1
+        self._pulses_since_update += 1
+        if self._pulses_since_update >= self._update_interval:
+            self.update()
+        return energy
+
+    def update(self):
+        self._peak_positions = fit_peaks(self._amplitude_edges, self._amplitude_counts,
+                                         self._peak_positions, self._window)
+        self._history.append((self._pulse_count, tuple(self._peak_positions)))
+        self._update_calibration()
+        self._amplitude_counts *= self._memory
+        self._pulses_since_update = 0
+
+    def calibrate(self, amplitude):
+        return self._gain * amplitude + self._offset
+
+    @property
+    def peak_positions(self):
+        return tuple(self._peak_positions)
+
+    @property
+    def history(self):
+        return tuple(self._history)
+
+    @property
+    def gain(self):
+        return self._gain
+
+    @property
+    def offset(self):
+        return self._offset
+
+    @property
+    def spectrum(self):
+        return self._energy_edges, self._energy_counts.copy()
+
+    def _update_calibration(self):
+        if len(self._peak_positions) > 1:
+            self._gain, self._offset = np.polyfit(self._peak_positions, self._peak_energies, 1)
+        elif self._is_away_from_zero(self._peak_positions[0]):
+            self._gain = self._peak_energies[0] / self._peak_positions[0]
+            self._offset = 0.0
+
+    def _is_away_from_zero(self, amplitude):
+        return abs(amplitude) >= (self._amplitude_edges[1] - self._amplitude_edges[0]) / 2
+
+    def _add(self, edges, counts, value):
+        index = np.searchsorted(edges, value, side='right') - 1
+        if 0 <= index < len(counts):
+            counts[index] += 1
+
+
+def fit_peaks(edges, counts, positions, half_width):
+    '''Fit a Gaussian on a linear background around each peak position of a histogram.'''
+    centers = (edges[:-1] + edges[1:]) / 2
+    bin_width = edges[1] - edges[0]
+    positions = np.asarray(positions, dtype=float)
+    width = 2 * half_width + 1
+    start = np.clip(np.searchsorted(centers, positions) - half_width, 0, len(centers) - width)
+    indices = start[:, np.newaxis] + np.arange(width)
+    x = centers[indices]
+    y = counts[indices]
+
+    background = y[:, :1] + (y[:, -1:] - y[:, :1]) * (x - x[:, :1]) / (x[:, -1:] - x[:, :1])
+    net = np.clip(y - background, 0, None)
+    total = net.sum(axis=1)
+
+    u = (x - positions[:, np.newaxis]) / bin_width
+    design = np.stack((np.ones_like(u), u, u**2), axis=-1)
+    weights = net**2
+    log_net = np.log(np.where(net > 0, net, 1))
+    normal = np.einsum('nw,nwi,nwj->nij', weights, design, design)
+    rhs = np.einsum('nw,nwi,nw->ni', weights, design, log_net)
+    coefficients = np.einsum('nij,nj->ni', np.linalg.pinv(normal), rhs)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fitted = positions - coefficients[:, 1] / (2 * coefficients[:, 2]) * bin_width
+        centroid = np.where(total > 0, (net * x).sum(axis=1) / total, positions)
+    valid = ((coefficients[:, 2] < 0) & np.isfinite(fitted)
+             & (fitted >= x[:, 0]) & (fitted <= x[:, -1]))
+    return np.where(valid, fitted, centroid)
+
+
 class RedPitayaGeneratorChannel(PulseWriter):
     
     def __init__(self, channel_id, connection, generator):
         self._channel_id = channel_id
         self._connection = connection
         self._generator = generator
+        self._amplitudes = None
+        self._dead_time = None
         
     def open(self):
         self._connection.open()
@@ -198,11 +669,7 @@ class RedPitayaGeneratorChannel(PulseWriter):
 
     def write(self, pulse):
         self._generator.reset()
-
-        self._generator.set_waveform(self.channel_id, Waveform.ARBITRARY)
-        self._generator.set_arbitrary_waveform_data(self.channel_id, pulse.voltages)
-        pulse_sampling_period = pulse.times[1] - pulse.times[0]
-        self._generator.set_frequency(self.channel_id, int(1/(pulse_sampling_period*16384)))
+        self._upload(pulse.voltages, pulse.times[1] - pulse.times[0])
         self._generator.set_amplitude(self.channel_id, 1)
 
         self._generator.set_burst_count(self.channel_id, 1)
@@ -213,6 +680,67 @@ class RedPitayaGeneratorChannel(PulseWriter):
         self._generator.enable_burst(self.channel_id)
         self._generator.trigger_immediately(self.channel_id)
 
+    def load_bank(self, pulse, amplitudes):
+        '''Upload the shape of pulse scaled to a 1 V peak, to be played back at the given amplitudes.'''
+        self._generator.reset()
+        frequency = self._upload(pulse.normalize_voltages().voltages, pulse.times[1] - pulse.times[0])
+
+        burst_period = int(np.ceil(1e6 / frequency))
+        self._generator.set_burst_count(self.channel_id, 1)
+        self._generator.set_burst_repetitions(self.channel_id, 1)
+        self._generator.set_burst_period(self.channel_id, burst_period)
+
+        self._generator.enable_output(self.channel_id)
+        self._generator.enable_burst(self.channel_id)
+        self._amplitudes = tuple(amplitudes)
+        self._dead_time = burst_period * 1e-6
+
+    def play_train(self, spectrum, rate, count, random_state=np.random):
+        '''Schedule count Poisson-spaced pulses and return the events actually fired.'''
+        if self._amplitudes is None:
+            raise ValueError('No waveform bank loaded')
+        if len(spectrum) != len(self._amplitudes):
+            raise ValueError('Spectrum and waveform bank sizes differ')
+
+        probabilities = np.asarray(spectrum, dtype=float)
+        probabilities = probabilities / probabilities.sum()
+        indices = random_state.choice(len(self._amplitudes), size=count, p=probabilities)
+        scheduled_times = np.cumsum(random_state.exponential(1.0 / rate, size=count))
+
+        events = []
+        current_amplitude = None
+        start_time = self._now()
+        for scheduled_time, index in zip(scheduled_times.tolist(), indices.tolist()):
+            if events and scheduled_time < events[-1].time + self._dead_time:
+                continue
+            delay = start_time + scheduled_time - self._now()
+            if delay > 0:
+                self._sleep(delay)
+            amplitude = self._amplitudes[index]
+            if amplitude != current_amplitude:
+                self._generator.set_amplitude(self.channel_id, amplitude)
+                current_amplitude = amplitude
+            events.append(Event(self._now() - start_time, amplitude))
+            self._generator.trigger_immediately(self.channel_id)
+        return tuple(events)
+
+    def _now(self):
+        return now()
+
+    def _sleep(self, delay):
+        sleep(delay)
+
+    def _upload(self, voltages, sampling_period):
+        self._generator.set_waveform(self.channel_id, Waveform.ARBITRARY)
+        self._generator.set_arbitrary_waveform_data(self.channel_id, voltages)
+        frequency = int(1/(sampling_period*16384))
+        self._generator.set_frequency(self.channel_id, frequency)
+        return frequency
+
+    @property
+    def amplitudes(self):
+        return self._amplitudes
+
     @property
     def closed(self):
         return self._connection.closed
@@ -224,10 +752,12 @@ class RedPitayaGeneratorChannel(PulseWriter):
 
 class RedPitayaOscilloscopeChannel(PulseReader):
 
-    def __init__(self, channel_id, connection, oscilloscope):
+    def __init__(self, channel_id, connection, oscilloscope, compact=False, pre_trigger_samples=0):
         self._channel_id = channel_id
         self._connection = connection
         self._oscilloscope = oscilloscope
+        self._compact = compact
+        self._pre_trigger_samples = pre_trigger_samples
     
     def open(self):
         self._connection.open()
@@ -244,7 +774,7 @@ class RedPitayaOscilloscopeChannel(PulseReader):
         self._oscilloscope.set_trigger_event(TriggerSource('CH{}'.format(self._channel_id)), Edge.POSITIVE)
 
         times, voltages = self._oscilloscope.get_acquisition(self._channel_id)
-        return Pulse(tuple([Sample(time, voltage) for time, voltage in zip(times, voltages)]))
+        return make_pulse(times, voltages, self._compact, self._pre_trigger_samples)
         
     @property
     def closed(self):
@@ -276,9 +806,10 @@ class RedPitaya(object):
         generator = Generator(connection)
         return RedPitayaGeneratorChannel(channel_id, connection, generator)
 
-    def get_oscilloscope_channel(self, channel_id):
+    def get_oscilloscope_channel(self, channel_id, compact=False, pre_trigger_samples=0):
         if channel_id not in (1, 2):
             raise ValueError('Invalid channel id')
         connection = get_tcpip_scpi_connection(self._host, self._port, timeout=1)        
         oscilloscope = Oscilloscope(connection)
-        return RedPitayaOscilloscopeChannel(channel_id, connection, oscilloscope)
+        return RedPitayaOscilloscopeChannel(channel_id, connection, oscilloscope,
+                                            compact, pre_trigger_samples)
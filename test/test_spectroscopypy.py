@@ -1,7 +1,11 @@
-from mock import Mock
+from mock import Mock, patch
 from unittest import TestCase, skip
+import os
+import shutil
+import tempfile
 from spectroscopypy import *
 from scpipy import TriggerSource, Edge
+import numpy as np
 
 class SampleTest(TestCase):
 
@@ -115,7 +119,352 @@ class PulseTest(TestCase):
                        Sample(0.3, 0.75),
                        Sample(0.4, 1.0),))
         self.assertEqual(expected_pulse.voltages, normalized_pulse.voltages)
-        
+
+    def test_transforms_return_views(self):
+        pulse = Pulse(self.get_test_samples())
+        view = pulse.normalize_times().normalize_voltages()[1:]
+        self.assertEqual((('normalize_times',), ('normalize_voltages',), ('slice', slice(1, None))),
+                         view.operations)
+
+    def test_sliced_view_has_correct_length(self):
+        pulse = Pulse(self.get_test_samples())
+        self.assertEqual(1, len(pulse.normalize_voltages()[1:][:-1]))
+
+    def test_chained_transforms(self):
+        pulse = Pulse((Sample(0.1, 1.0),
+                       Sample(0.2, -4.0),
+                       Sample(0.3, 2.0),
+                       Sample(0.4, 4.0),))
+
+        transformed_pulse = pulse[1:].normalize_times().normalize_voltages()
+
+        self.assertEqual((0.0, 0.1, 0.2), tuple(round(time, 10) for time in transformed_pulse.times))
+        self.assertEqual((-1.0, 0.5, 1.0), transformed_pulse.voltages)
+
+    def test_smooth_after_normalization(self):
+        pulse = Pulse(tuple(Sample(0.1 * i, (i % 3) + 1.0) for i in range(10)))
+        expected_voltages = savitzky_golay(pulse.normalize_voltages().voltages, window_size=3, order=1)
+
+        smoothed_pulse = pulse.normalize_voltages().smooth(window_size=3, order=1)
+
+        np.testing.assert_allclose(expected_voltages, smoothed_pulse.voltages)
+        self.assertEqual(pulse.times, smoothed_pulse.times)
+
+    def test_smooth_preserves_straight_line(self):
+        pulse = Pulse(tuple(Sample(0.1 * i, 2.0 * i) for i in range(10)))
+        smoothed_pulse = pulse.smooth(window_size=5, order=2)
+        for expected, actual in zip(pulse.voltages[2:-2], smoothed_pulse.voltages[2:-2]):
+            self.assertAlmostEqual(expected, actual)
+
+    def test_smooth_with_window_longer_than_pulse(self):
+        pulse = Pulse(tuple(Sample(0.1 * i, 1.0) for i in range(300)))
+        with self.assertRaises(ValueError):
+            pulse.smooth()
+
+    def test_smoothed_view_length_matches_samples(self):
+        pulse = Pulse(tuple(Sample(0.1 * i, (i % 3) + 1.0) for i in range(10)))
+        smoothed_pulse = pulse.smooth(window_size=10, order=2)
+        self.assertEqual(10, len(smoothed_pulse))
+        self.assertEqual(10, len(smoothed_pulse.voltages))
+        self.assertEqual(10, len(list(smoothed_pulse)))
+
+    def test_get_sample_of_view_by_index(self):
+        pulse = Pulse(self.get_test_samples())
+        self.assertEqual(Sample(0.1, 0.5), pulse.normalize_voltages()[1])
+        self.assertEqual(Sample(0.2, 1.0), pulse.normalize_voltages()[-1])
+
+    def test_view_contains_sample(self):
+        pulse = Pulse(self.get_test_samples())
+        self.assertIn(Sample(0.1, 0.5), pulse.normalize_voltages())
+
+    def test_view_can_be_iterated(self):
+        pulse = Pulse(self.get_test_samples())
+        self.assertEqual(list(pulse.normalize_times()), list(self.get_test_samples()))
+
+
+class CompactPulseTest(TestCase):
+
+    def setUp(self):
+        self.times = (0.0, 1e-6, 2e-6, 3e-6, 4e-6)
+        self.voltages = (0.1, 0.1, 0.9, 0.5, -0.2)
+        self.pulse = CompactPulse.from_arrays(self.times, self.voltages)
+
+    def test_compact_pulse_has_correct_length(self):
+        self.assertEqual(5, len(self.pulse))
+
+    def test_time_axis_is_stored_as_start_and_period(self):
+        self.assertAlmostEqual(0.0, self.pulse.t0)
+        self.assertAlmostEqual(1e-6, self.pulse.dt)
+
+    def test_voltages_are_stored_as_int16(self):
+        self.assertEqual(np.int16, self.pulse.codes.dtype)
+
+    def test_get_times(self):
+        np.testing.assert_allclose(self.times, self.pulse.times)
+
+    def test_get_voltages(self):
+        np.testing.assert_allclose(self.voltages, self.pulse.voltages, atol=1e-4)
+
+    def test_get_maximum_voltage(self):
+        self.assertAlmostEqual(0.9, self.pulse.get_maximum_voltage(), delta=1e-4)
+
+    def test_get_sample_by_index(self):
+        self.assertAlmostEqual(0.5, self.pulse[3].voltage, delta=1e-4)
+
+    def test_get_sample_by_negative_index(self):
+        self.assertAlmostEqual(4e-6, self.pulse[-1].time)
+        self.assertAlmostEqual(-0.2, self.pulse[-1].voltage, delta=1e-4)
+
+    def test_get_sample_out_of_range(self):
+        with self.assertRaises(IndexError):
+            self.pulse[5]
+
+    def test_get_subpulse_by_slicing(self):
+        subpulse = self.pulse[1:3]
+        self.assertIsInstance(subpulse, CompactPulse)
+        np.testing.assert_allclose(self.times[1:3], subpulse.times)
+        np.testing.assert_allclose(self.voltages[1:3], subpulse.voltages, atol=1e-4)
+
+    def test_get_subpulse_by_slicing_with_step(self):
+        subpulse = self.pulse[::-2]
+        np.testing.assert_allclose(self.times[::-2], subpulse.times)
+        np.testing.assert_allclose(self.voltages[::-2], subpulse.voltages, atol=1e-4)
+
+    def test_compact_pulse_can_be_iterated(self):
+        self.assertEqual(list(self.pulse), [self.pulse[i] for i in range(len(self.pulse))])
+
+    def test_compact_pulse_contains_sample(self):
+        self.assertIn(self.pulse[2], self.pulse)
+
+    def test_non_uniform_time_axis(self):
+        with self.assertRaises(ValueError):
+            CompactPulse.from_arrays((0.0, 1.0, 5.0), (0.1, 0.2, 0.3))
+
+    def test_make_pulse_with_non_uniform_time_axis(self):
+        with self.assertRaises(ValueError):
+            make_pulse((0.0, 1.0, 5.0), (0.1, 0.2, 0.3), compact=True)
+
+    def test_make_pulse_with_baseline_subtraction(self):
+        pulse = make_pulse((0.0, 1.0, 2.0), (0.1, 0.3, 1.2), pre_trigger_samples=2)
+        np.testing.assert_allclose((-0.1, 0.1, 1.0), pulse.voltages)
+
+    def test_constant_voltages(self):
+        pulse = CompactPulse.from_arrays(self.times, (0.3,) * 5)
+        np.testing.assert_allclose((0.3,) * 5, pulse.voltages)
+
+    def test_empty_compact_pulse(self):
+        self.assertEqual(0, len(CompactPulse.from_arrays((), ())))
+
+
+class SubtractBaselineTest(TestCase):
+
+    def test_subtract_baseline_from_pulse(self):
+        np.testing.assert_allclose((-0.1, 0.1, 1.0), subtract_baseline((0.1, 0.3, 1.2), 2))
+
+    def test_subtract_baseline_from_several_pulses(self):
+        voltages = np.array(((0.1, 0.3, 1.2), (1.0, 1.0, 2.0)))
+        np.testing.assert_allclose(((-0.1, 0.1, 1.0), (0.0, 0.0, 1.0)), subtract_baseline(voltages, 2))
+
+    def test_no_pre_trigger_samples(self):
+        np.testing.assert_allclose((0.1, 0.3, 1.2), subtract_baseline((0.1, 0.3, 1.2), 0))
+
+
+class PulseCacheTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = PulseCache(self.directory)
+        self.pulse = Pulse((Sample(0.0, 0.0),
+                            Sample(0.1, 1.0),
+                            Sample(0.2, 2.0),
+                            Sample(0.3, 3.0),
+                            Sample(0.4, 4.0),))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_missing_entry(self):
+        self.assertIsNone(self.cache.get('missing'))
+
+    def test_apply_returns_transformed_pulse(self):
+        cached_pulse = self.cache.apply(self.pulse, 'normalize_voltages')
+        self.assertEqual(self.pulse.normalize_voltages().voltages, cached_pulse.voltages)
+
+    def test_apply_stores_transformed_pulse(self):
+        self.cache.apply(self.pulse, 'normalize_voltages')
+        key = self.cache.get_key(self.pulse, 'normalize_voltages')
+        self.assertEqual(self.pulse.normalize_voltages(), self.cache.get(key))
+
+    def test_apply_does_not_recompute_cached_pulse(self):
+        pulse = CountingPulse(self.pulse)
+        self.cache.apply(pulse, 'smooth', window_size=3, order=1)
+        self.cache.apply(pulse, 'smooth', window_size=3, order=1)
+        self.assertEqual(1, pulse.smooth_calls)
+
+    def test_cache_miss_and_hit_return_plain_pulses(self):
+        missed_pulse = self.cache.apply(self.pulse, 'normalize_voltages')
+        hit_pulse = self.cache.apply(self.pulse, 'normalize_voltages')
+        self.assertIs(Pulse, type(missed_pulse))
+        self.assertIs(Pulse, type(hit_pulse))
+        self.assertEqual(missed_pulse, hit_pulse)
+
+    def test_apply_feature_extraction(self):
+        missed_value = self.cache.apply(self.pulse, 'get_maximum_voltage')
+        hit_value = self.cache.apply(self.pulse, 'get_maximum_voltage')
+        self.assertEqual(4.0, missed_value)
+        self.assertEqual(4.0, hit_value)
+        self.assertIs(type(missed_value), type(hit_value))
+
+    def test_put_when_another_writer_stored_the_same_key(self):
+        self.cache.put('entry', self.pulse)
+        with patch('os.rename', Mock(side_effect=OSError)), patch('os.replace', Mock(side_effect=OSError),
+                                                                   create=True):
+            self.cache.put('entry', self.pulse)
+        self.assertEqual(self.pulse, self.cache.get('entry'))
+        self.assertEqual(['entry.dat'], os.listdir(self.directory))
+
+    def test_key_depends_on_parameters(self):
+        self.assertNotEqual(self.cache.get_key(self.pulse, 'smooth', window_size=3, order=1),
+                            self.cache.get_key(self.pulse, 'smooth', window_size=5, order=1))
+
+    def test_key_resolves_default_parameters(self):
+        self.assertEqual(self.cache.get_key(self.pulse, 'smooth'),
+                         self.cache.get_key(self.pulse, 'smooth', window_size=1000, order=4))
+
+    def test_key_depends_on_version(self):
+        key = self.cache.get_key(self.pulse, 'normalize_voltages')
+        self.cache.VERSION = PulseCache.VERSION + 1
+        self.assertNotEqual(key, self.cache.get_key(self.pulse, 'normalize_voltages'))
+
+    def test_stale_temporary_file_is_evicted(self):
+        path = os.path.join(self.directory, 'orphan.tmp')
+        with open(path, 'wb') as temporary_file:
+            temporary_file.write(b'\0' * 1024)
+        os.utime(path, (0, 0))
+        cache = PulseCache(self.directory, max_size=1024)
+        cache.put('entry', self.pulse)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.pulse, cache.get('entry'))
+
+    def test_recent_temporary_file_is_kept(self):
+        path = os.path.join(self.directory, 'writing.tmp')
+        with open(path, 'wb') as temporary_file:
+            temporary_file.write(b'\0' * 1024)
+        cache = PulseCache(self.directory, max_size=1024)
+        cache.put('entry', self.pulse)
+        self.assertTrue(os.path.exists(path))
+
+    def test_key_depends_on_samples(self):
+        self.assertNotEqual(self.cache.get_key(self.pulse, 'normalize_times'),
+                            self.cache.get_key(self.pulse[1:], 'normalize_times'))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        entry_size = 2 * 8 * len(self.pulse)
+        cache = PulseCache(self.directory, max_size=2 * entry_size)
+        cache.put('first', self.pulse)
+        cache.put('second', self.pulse)
+        os.utime(os.path.join(self.directory, 'first.dat'), (0, 0))
+        cache.put('third', self.pulse)
+        self.assertIsNone(cache.get('first'))
+        self.assertEqual(self.pulse, cache.get('second'))
+        self.assertEqual(self.pulse, cache.get('third'))
+
+    def test_clear(self):
+        self.cache.put('entry', self.pulse)
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('entry'))
+
+
+class FitPeaksTest(TestCase):
+
+    def test_fit_peaks_on_linear_background(self):
+        edges = np.linspace(0.0, 1.0, 201)
+        centers = (edges[:-1] + edges[1:]) / 2
+        counts = (1000 * np.exp(-(centers - 0.3)**2 / (2 * 0.01**2))
+                  + 500 * np.exp(-(centers - 0.62)**2 / (2 * 0.015**2))
+                  + 50 - 20 * centers)
+
+        positions = fit_peaks(edges, counts, (0.29, 0.63), half_width=15)
+
+        self.assertAlmostEqual(0.3, positions[0], delta=0.001)
+        self.assertAlmostEqual(0.62, positions[1], delta=0.001)
+
+    def test_fit_peaks_without_counts_keeps_positions(self):
+        edges = np.linspace(0.0, 1.0, 201)
+        positions = fit_peaks(edges, np.zeros(200), (0.3, 0.6), half_width=10)
+        self.assertEqual((0.3, 0.6), tuple(positions))
+
+
+class PeakTrackingCalibratorTest(TestCase):
+
+    def get_pulses(self, random_state, gain, count):
+        amplitudes = np.where(random_state.uniform(size=count) < 0.5, 0.3, 0.6) * gain
+        amplitudes = amplitudes + random_state.normal(0, 0.005, size=count)
+        return [Pulse((Sample(0.0, 0.0), Sample(1e-6, amplitude))) for amplitude in amplitudes]
+
+    def test_calibrator_is_closed_on_creation(self):
+        self.assertTrue(PeakTrackingCalibrator((0.3, 0.6)).closed)
+
+    def test_calibrator_is_not_closed_after_open(self):
+        calibrator = PeakTrackingCalibrator((0.3, 0.6))
+        calibrator.open()
+        self.assertFalse(calibrator.closed)
+
+    def test_different_number_of_peak_amplitudes_and_energies(self):
+        with self.assertRaises(ValueError):
+            PeakTrackingCalibrator((0.3,), (481.69, 975.65))
+
+    def test_window_wider_than_histogram(self):
+        with self.assertRaises(ValueError):
+            PeakTrackingCalibrator((0.3, 0.6), bins=16, window=8)
+
+    def test_single_peak_at_zero_amplitude(self):
+        with self.assertRaises(ValueError):
+            PeakTrackingCalibrator((0.0,), (481.69,))
+
+    def test_single_peak_calibration_is_kept_if_peak_moves_to_zero(self):
+        calibrator = PeakTrackingCalibrator((0.2,), (200.0,), amplitude_range=(-0.5, 0.5), bins=5, window=2,
+                                            update_interval=1)
+        calibrator.write(Pulse((Sample(0.0, -0.1), Sample(1e-6, 0.0))))
+        self.assertAlmostEqual(0.0, calibrator.peak_positions[0])
+        self.assertAlmostEqual(1000.0, calibrator.gain)
+
+    def test_initial_calibration(self):
+        calibrator = PeakTrackingCalibrator((0.3, 0.6), (300.0, 600.0))
+        self.assertAlmostEqual(1000.0, calibrator.gain)
+        self.assertAlmostEqual(0.0, calibrator.offset)
+
+    def test_write_returns_calibrated_energy(self):
+        calibrator = PeakTrackingCalibrator((0.3, 0.6), (300.0, 600.0))
+        with calibrator:
+            energy = calibrator.write(Pulse((Sample(0.0, 0.0), Sample(1e-6, 0.45))))
+        self.assertAlmostEqual(450.0, energy)
+        self.assertEqual(1, calibrator.spectrum[1].sum())
+
+    def test_tracks_gain_drift(self):
+        random_state = np.random.RandomState(0)
+        calibrator = PeakTrackingCalibrator((0.3, 0.6), (300.0, 600.0), update_interval=500)
+        with calibrator:
+            for gain in (1.0, 1.02, 1.04, 1.06):
+                for pulse in self.get_pulses(random_state, gain, 1000):
+                    calibrator.write(pulse)
+
+        self.assertEqual(9, len(calibrator.history))
+        self.assertAlmostEqual(0.3 * 1.06, calibrator.peak_positions[0], delta=0.005)
+        self.assertAlmostEqual(0.6 * 1.06, calibrator.peak_positions[1], delta=0.005)
+        self.assertAlmostEqual(600.0, calibrator.calibrate(0.6 * 1.06), delta=5.0)
+
+
+class CountingPulse(Pulse):
+
+    def __init__(self, pulse):
+        Pulse.__init__(self, tuple(pulse))
+        self.smooth_calls = 0
+
+    def smooth(self, window_size=1000, order=4):
+        self.smooth_calls += 1
+        return Pulse.smooth(self, window_size, order)
+
 
 class PulseDataFileReaderTest(TestCase):
 
@@ -197,6 +546,56 @@ class RedPitayaGeneratorChannelTest(TestCase):
         self.channel.generator.set_burst_repetitions.assert_called_once_with(self.CHANNEL_ID, 1)
         self.channel.generator.set_burst_period.assert_called_once_with(self.CHANNEL_ID, 2000)
         self.channel.generator.enable_output.assert_called_once_with(self.CHANNEL_ID)
+
+    def test_load_bank(self):
+        self.channel.load_bank(Pulse((Sample(0, 0), Sample(1e-6, 2), Sample(2e-6, 4), Sample(3e-6, -1))),
+                               (0.1, 0.5))
+        self.channel.generator.set_arbitrary_waveform_data.assert_called_once_with(
+            self.CHANNEL_ID, (0, 0.5, 1, -0.25))
+        self.channel.generator.set_frequency.assert_called_once_with(self.CHANNEL_ID, 61)
+        self.channel.generator.set_burst_period.assert_called_once_with(self.CHANNEL_ID, 16394)
+        self.channel.generator.enable_output.assert_called_once_with(self.CHANNEL_ID)
+        self.assertFalse(self.channel.generator.trigger_immediately.called)
+        self.assertEqual((0.1, 0.5), self.channel.amplitudes)
+
+    def test_play_train_without_bank(self):
+        with self.assertRaises(ValueError):
+            self.channel.play_train((1,), rate=1e6, count=1)
+
+    def test_play_train_with_wrong_spectrum_size(self):
+        self.channel.load_bank(Pulse((Sample(0, 0), Sample(1e-6, 2))), (0.1, 0.5))
+        with self.assertRaises(ValueError):
+            self.channel.play_train((1,), rate=1e6, count=1)
+
+    def test_play_train(self):
+        self.channel.load_bank(Pulse((Sample(0, 0), Sample(1e-6, 2))), (0.1, 0.5))
+
+        events = self.channel.play_train((0, 1), rate=1, count=5, random_state=np.random.RandomState(0))
+
+        self.assertEqual(5, len(events))
+        self.assertTrue(all(event.amplitude == 0.5 for event in events))
+        self.assertEqual(sorted(event.time for event in events), [event.time for event in events])
+        self.channel.generator.set_amplitude.assert_called_once_with(self.CHANNEL_ID, 0.5)
+        self.assertEqual(5, self.channel.generator.trigger_immediately.call_count)
+
+    def test_play_train_drops_events_within_dead_time(self):
+        self.channel.load_bank(Pulse((Sample(0, 0), Sample(1e-6, 2))), (0.1, 0.5))
+
+        events = self.channel.play_train((1, 1), rate=1000, count=100, random_state=np.random.RandomState(0))
+
+        self.assertLess(len(events), 100)
+        self.assertTrue(all(later.time - earlier.time >= 0.016394
+                            for earlier, later in zip(events, events[1:])))
+        self.assertEqual(len(events), self.channel.generator.trigger_immediately.call_count)
+
+    def test_play_train_records_actual_trigger_times(self):
+        self.channel.load_bank(Pulse((Sample(0, 0), Sample(1e-6, 2))), (0.1, 0.5))
+        self.channel.generator.set_amplitude.side_effect = lambda channel_id, amplitude: self.channel.wait(0.5)
+
+        events = self.channel.play_train((0, 1), rate=1000, count=3, random_state=np.random.RandomState(0))
+
+        self.assertEqual(1, len(events))
+        self.assertGreater(events[0].time, 0.5)
         
 
 class TestableRedPitayaGeneratorChannel(RedPitayaGeneratorChannel):
@@ -204,6 +603,16 @@ class TestableRedPitayaGeneratorChannel(RedPitayaGeneratorChannel):
     def __init__(self, channel_id, connection, generator):
         RedPitayaGeneratorChannel.__init__(self, channel_id, connection, generator)
         self.generator = generator
+        self.clock = 0.0
+
+    def wait(self, delay):
+        self.clock += delay
+
+    def _now(self):
+        return self.clock
+
+    def _sleep(self, delay):
+        self.wait(delay)
         
 
 class RedPitayaOscilloscopeChannelTest(TestCase):
@@ -242,9 +651,19 @@ class RedPitayaOscilloscopeChannelTest(TestCase):
         self.assertEqual(Pulse((Sample(0, 0), Sample(1e-6, 2), Sample(2e-6, 4), Sample(3e-6, -1))), pulse)
 
 
+    def test_read_compact_pulse_with_baseline_subtraction(self):
+        channel = TestableRedPitayaOscilloscopeChannel(self.CHANNEL_ID, FakeConnection(), self.channel.oscilloscope,
+                                                       compact=True, pre_trigger_samples=2)
+        pulse = channel.read()
+        self.assertIsInstance(pulse, CompactPulse)
+        np.testing.assert_allclose((0, 1e-6, 2e-6, 3e-6), pulse.times)
+        np.testing.assert_allclose((-1, 1, 3, -2), pulse.voltages, atol=1e-3)
+
+
 class TestableRedPitayaOscilloscopeChannel(RedPitayaOscilloscopeChannel):
-    def __init__(self, channel_id, connection, oscilloscope):
-        RedPitayaOscilloscopeChannel.__init__(self, channel_id, connection, oscilloscope)
+    def __init__(self, channel_id, connection, oscilloscope, compact=False, pre_trigger_samples=0):
+        RedPitayaOscilloscopeChannel.__init__(self, channel_id, connection, oscilloscope,
+                                              compact, pre_trigger_samples)
         self.connection = connection
         self.oscilloscope = oscilloscope
 
@@ -316,6 +735,9 @@ class Oscilloscope(object):
     def start(self):
         pass
 
+    def set_trigger_level(self, level):
+        pass
+
     def set_trigger_event(self):
         pass
 